@@ -1,57 +1,167 @@
 import streamlit as st
-import yfinance as yf
 import pandas as pd
+import numpy as np
 import pytz
-from datetime import datetime, time
+import os
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
 
 # --- Page Configuration ---
 st.set_page_config(page_title="Forex Safety Shield", layout="centered", page_icon="🛡️")
 
 # --- Constants ---
 USER_TIMEZONE = pytz.timezone('Europe/Riga')
+NY_TIMEZONE = pytz.timezone('US/Eastern')
+CACHE_DIR = Path(__file__).parent / "cache"
+CACHE_RETRY_SECONDS = 60
+ATTEMPT_MARKER = CACHE_DIR / "last_download"
+SYMBOL_MAP = {"EUR/USD": "EURUSD=X", "USD/JPY": "JPY=X"}
+PAIRS = tuple(SYMBOL_MAP)
+PIP_UNIT = {pair: 0.01 if pair.endswith("JPY") else 0.0001 for pair in PAIRS}
+ROLLOVER_START = 16 * 60 + 50 # 16:50 NY
+ROLLOVER_END = 18 * 60 + 5    # 18:05 NY
+HLC_COLUMNS = ["High", "Low", "Close"]
+MIN_DAILY_BARS = 50 # Wilder's ATR (14) needs ~50 bars to settle
 
-# --- Helper Functions ---
-def get_pip_unit(pair):
-    if "JPY" in pair: return 0.01
-    return 0.0001
+# --- Data Layer: Daily Candles (Disk Cache) ---
+def candle_path(symbol):
+    return CACHE_DIR / f"{symbol}_1d.parquet"
 
-# --- Data Engine: Daily ATR Only (Cached 60s) ---
-@st.cache_data(ttl=60, show_spinner=False)
-def get_daily_atr(symbol, pip_unit):
+def read_candles(symbol):
+    path = candle_path(symbol)
+    if not path.exists():
+        return pd.DataFrame()
     try:
-        # 1. Fetch Daily Data Only (Lightweight)
-        # We grab 3 months to ensure the 14-day average is smooth
-        df_daily = yf.download(symbol, period="3mo", interval="1d", progress=False, auto_adjust=False)
-        
-        # Flatten columns if MultiIndex (yfinance bug fix)
-        if isinstance(df_daily.columns, pd.MultiIndex):
-            df_daily.columns = df_daily.columns.get_level_values(0)
-            
-        # Safety Check: Need at least 18 days
-        if df_daily.empty or len(df_daily) < 18: 
-            return {"error": "Insufficient Data"}
-        
-        # 2. THE SUNDAY PURGE
-        # Remove Sundays so they don't drag down the average
-        df_daily = df_daily[df_daily.index.dayofweek != 6]
-
-        # 3. Calculate ATR (14)
-        df_daily['h_l'] = df_daily['High'] - df_daily['Low']
-        df_daily['h_pc'] = (df_daily['High'] - df_daily['Close'].shift(1)).abs()
-        df_daily['l_pc'] = (df_daily['Low'] - df_daily['Close'].shift(1)).abs()
-        df_daily['TR'] = df_daily[['h_l', 'h_pc', 'l_pc']].max(axis=1)
-        df_daily['ATR'] = df_daily['TR'].rolling(window=14).mean()
-        
-        # 4. Use Yesterday's Closed Candle (iloc[-2])
-        # This ensures the number is stable for the whole trading day
-        current_atr_val = float(df_daily['ATR'].iloc[-2])
-        
-        return {
-            "atr_pips": current_atr_val / pip_unit,
-            "error": None
-        }
-    except Exception as e:
-        return {"error": str(e)}
+        return pd.read_parquet(path, columns=HLC_COLUMNS)
+    except Exception:
+        return pd.DataFrame()  # Corrupt or partial file: download it again
+
+def write_candles(symbol, df):
+    # Write to a temp file and swap it in, so readers and concurrent
+    # sessions never see a half-written parquet file
+    tmp_path = None
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        os.close(fd)
+        df.to_parquet(tmp_path)
+        os.replace(tmp_path, candle_path(symbol))
+    except OSError:
+        pass  # Read-only filesystem: still serve the downloaded data
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def modified_on(path, utc_date):
+    # Written on utc_date (UTC), i.e. after the previous day's candle closed
+    return datetime.fromtimestamp(path.stat().st_mtime, pytz.utc).date() == utc_date
+
+def download_attempted_recently():
+    try:
+        return time.time() - ATTEMPT_MARKER.stat().st_mtime < CACHE_RETRY_SECONDS
+    except OSError:
+        return False
+
+def mark_download_attempt():
+    # Touched before every download, so failed attempts count too
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        ATTEMPT_MARKER.touch()
+    except OSError:
+        pass
+
+def load_daily_candles(symbol, utc_date):
+    # Candles are kept on disk per symbol so cold starts and refreshes
+    # only download the rows we don't already have
+    cached = read_candles(symbol)
+
+    # Fresh once today's candle is stored (yesterday's is then closed)
+    if not cached.empty and cached.index[-1].date() >= utc_date:
+        return cached
+
+    # At most one download per CACHE_RETRY_SECONDS across all sessions,
+    # so a Yahoo outage isn't hit again on every rerun
+    if download_attempted_recently():
+        # Yahoo may not have opened today's candle yet: serve what was stored
+        # today, never a file from before midnight UTC (its last candle was open)
+        if not cached.empty and modified_on(candle_path(symbol), utc_date):
+            return cached
+        raise ValueError("No Data From Yahoo")
+    mark_download_attempt()
+
+    # Stale: refresh every pair in one request so switching pairs is free
+    # (yfinance is only imported once a download is actually needed)
+    import yfinance as yf
+    symbols = list(SYMBOL_MAP.values())
+    stored = {s: (cached if s == symbol else read_candles(s)) for s in symbols}
+    if any(df.empty for df in stored.values()):
+        # We grab 3 months so Wilder's smoothing is fully warmed up
+        window = {"period": "3mo"}
+    else:
+        # Re-fetch the last stored candles too, they may have been in progress
+        window = {"start": min(df.index[-1].date() for df in stored.values())}
+    # Always (ticker, field) columns, even if only one pair is configured
+    batch = yf.download(
+        symbols, interval="1d", group_by="ticker", multi_level_index=True,
+        progress=False, auto_adjust=True, **window
+    )
+
+    refreshed = set()
+    for s in symbols:
+        if s not in batch.columns.get_level_values(0):
+            continue
+        # ATR only needs High/Low/Close, drop the rest before storing
+        df = pd.concat([stored[s], batch[s][HLC_COLUMNS].dropna(how="all")])
+        df = df[~df.index.duplicated(keep="last")]
+        if df.empty:
+            continue
+
+        # Keep the same 3 month window so the file doesn't grow forever
+        df = df[df.index >= df.index[-1] - pd.DateOffset(months=3)]
+        write_candles(s, df)
+        stored[s] = df
+        refreshed.add(s)
+
+    # Don't fall back to the stale file, its last candle may be incomplete
+    if symbol not in refreshed:
+        raise ValueError("No Data From Yahoo")
+    return stored[symbol]
+
+# --- Data Engine: Daily ATR Only (Cached per UTC day) ---
+# Failures raise instead of returning an error dict: Streamlit doesn't cache
+# exceptions, so a bad fetch is retried on the next rerun, not tomorrow
+@st.cache_data(ttl=86400, show_spinner=False)
+def get_daily_atr(symbol, pip_unit, utc_date):
+    # 1. Fetch Daily Data Only (Lightweight, mostly from disk)
+    df_daily = load_daily_candles(symbol, utc_date)
+
+    # 2. THE SUNDAY PURGE
+    # Remove Sundays so they don't drag down the average
+    # (masking the plain array, no filtered DataFrame is built)
+    not_sunday = df_daily.index.weekday != 6
+    hlc = df_daily[HLC_COLUMNS].to_numpy(dtype=np.float64)[not_sunday]
+
+    # 3. Calculate ATR (14) on Yesterday's Closed Candle
+    # This ensures the number is stable for the whole trading day
+    # (today's candle is still open, drop it only if Yahoo already has one)
+    if len(hlc) and df_daily.index[not_sunday][-1].date() >= utc_date:
+        hlc = hlc[:-1]
+
+    # Safety Check: Enough history for the smoothing to settle
+    # (counted on exactly the rows the kernel gets)
+    if len(hlc) < MIN_DAILY_BARS: 
+        raise ValueError("Insufficient Data")
+    # One contiguous array per series, the layout the kernel was warmed up with
+    # (Numba and the kernel are only loaded once an ATR is actually needed)
+    from indicators import calculate_atr
+    high, low, close = np.ascontiguousarray(hlc.T)
+    current_atr_val = float(calculate_atr(high, low, close))
+    
+    return {
+        "atr_pips": current_atr_val / pip_unit
+    }
 
 # --- MAIN APP UI ---
 
@@ -59,7 +169,7 @@ def get_daily_atr(symbol, pip_unit):
 c_refresh, c_title = st.columns([1, 3])
 with c_refresh:
     if st.button("🔄 Refresh"):
-        st.cache_data.clear()
+        get_daily_atr.clear()
         st.rerun()
 with c_title:
     st.title("Forex Shield")
@@ -72,11 +182,11 @@ def update_pair():
     st.session_state.pair_selection = st.session_state.pair_widget
 
 # 1. Top Control Bar
-current_index = 0 if st.session_state.pair_selection == "EUR/USD" else 1
+current_index = PAIRS.index(st.session_state.pair_selection)
 
 pair_option = st.radio(
     "Select Pair:", 
-    ["EUR/USD", "USD/JPY"], 
+    PAIRS, 
     horizontal=True, 
     index=current_index,
     key="pair_widget", 
@@ -88,51 +198,54 @@ st.markdown("###")
 st.link_button("📅 Open ForexFactory Calendar", "https://www.forexfactory.com/calendar")
 
 # Source of Truth
-symbol_map = {"EUR/USD": "EURUSD=X", "USD/JPY": "JPY=X"}
-ticker = symbol_map[st.session_state.pair_selection]
-pip_unit = get_pip_unit(st.session_state.pair_selection)
+ticker = SYMBOL_MAP[st.session_state.pair_selection]
+pip_unit = PIP_UNIT[st.session_state.pair_selection]
 
 st.divider()
 
 # --- WEEKEND CHECK ---
-now_latvia = datetime.now(USER_TIMEZONE)
+# One clock read per rerun, every local time is derived from it
+now_utc = datetime.fromtimestamp(time.time(), pytz.utc)
+now_latvia = now_utc.astimezone(USER_TIMEZONE)
 is_weekend = now_latvia.weekday() >= 5
 
 # --- SECTION 1: SAFETY CHECKS ---
 st.subheader("Environment Status")
+st.caption(f"App Time: {now_latvia.strftime('%H:%M:%S')} (Riga)")
+
+# Market closed: stop before any data layer code runs
+if is_weekend:
+    st.info("⚪ **MARKET CLOSED (Weekend)**")
+    st.markdown("Enjoy the break.")
+    st.divider()
+    st.stop()
 
 # A. Rollover Check (US Eastern Time)
-ny_tz = pytz.timezone('US/Eastern')
-now_ny = datetime.now(ny_tz)
+now_ny = now_utc.astimezone(NY_TIMEZONE)
 ny_minutes = now_ny.hour * 60 + now_ny.minute
-start_minutes = 16 * 60 + 50 # 16:50 NY
-end_minutes = 18 * 60 + 5    # 18:05 NY
 
 is_rollover = False
-if start_minutes <= ny_minutes <= end_minutes:
+if ROLLOVER_START <= ny_minutes <= ROLLOVER_END:
     is_rollover = True
 
 # B. Data Fetching
 market_data = None
-if not is_weekend:
-    market_data = get_daily_atr(ticker, pip_unit)
+err_msg = None
+try:
+    market_data = get_daily_atr(ticker, pip_unit, now_utc.date())
+except Exception as e:
+    # Some exceptions carry no message, fall back to their type name
+    err_msg = str(e) or type(e).__name__
 
 # --- MASTER STATUS DISPLAY ---
-st.caption(f"App Time: {now_latvia.strftime('%H:%M:%S')} (Riga)")
+market_data_healthy = market_data is not None
 
-market_data_healthy = market_data and not market_data.get('error')
-
-if is_weekend:
-    st.info("⚪ **MARKET CLOSED (Weekend)**")
-    st.markdown("Enjoy the break.")
-
-elif is_rollover:
+if is_rollover:
     st.error("⚫ **NO TRADE (Rollover)**")
     st.markdown("Spreads are wide (NY Time 16:50 - 18:05).")
 
 elif not market_data_healthy:
     # Print specific error if it fails
-    err_msg = market_data.get('error') if market_data else "Unknown"
     st.warning(f"⚠️ **System Error: {err_msg}**")
 
 else:
@@ -142,37 +255,45 @@ else:
 st.divider()
 
 # --- SECTION 2: ATR CALCULATOR ---
-if not is_weekend:
-    if market_data_healthy:
-        atr_pips = market_data['atr_pips']
-        
-        st.subheader("Risk Sizing (Daily ATR)")
+# Fragment: editing a multiplier reruns only this block, not the whole app
+@st.fragment
+def risk_calculator(atr_pips):
+    st.subheader("Risk Sizing (Daily ATR)")
+    
+    def update_params():
+        st.query_params["sl"] = st.session_state.sl_mult
+        st.query_params["tp"] = st.session_state.tp_mult
+
+    if "sl_mult" not in st.session_state:
+        qp = st.query_params
+        st.session_state.sl_mult = float(qp.get("sl", 0.20))
+        st.session_state.tp_mult = float(qp.get("tp", 0.15))
+
+    c1, c2 = st.columns(2)
+    with c1:
+        st.number_input("SL Multiplier", key="sl_mult", step=0.01, format="%.2f", on_change=update_params)
+    with c2:
+        st.number_input("TP Multiplier", key="tp_mult", step=0.01, format="%.2f", on_change=update_params)
         
-        def update_params():
-            st.query_params["sl"] = st.session_state.sl_mult
-            st.query_params["tp"] = st.session_state.tp_mult
-
-        if "sl_mult" not in st.session_state:
-            qp = st.query_params
-            st.session_state.sl_mult = float(qp.get("sl", 0.20))
-            st.session_state.tp_mult = float(qp.get("tp", 0.15))
-
-        c1, c2 = st.columns(2)
-        with c1:
-            st.number_input("SL Multiplier", key="sl_mult", step=0.01, format="%.2f", on_change=update_params)
-        with c2:
-            st.number_input("TP Multiplier", key="tp_mult", step=0.01, format="%.2f", on_change=update_params)
-            
-        sl_dist = atr_pips * st.session_state.sl_mult
-        tp_dist = atr_pips * st.session_state.tp_mult
-
-        st.markdown("---")
-        res1, res2 = st.columns(2)
-        with res1:
-            st.markdown(f"<h3 style='text-align: center; color: #ff4b4b;'>STOP LOSS</h3>", unsafe_allow_html=True)
-            st.markdown(f"<h2 style='text-align: center;'>{sl_dist:.1f} pips</h2>", unsafe_allow_html=True)
-        with res2:
-            st.markdown(f"<h3 style='text-align: center; color: #09ab3b;'>TAKE PROFIT</h3>", unsafe_allow_html=True)
-            st.markdown(f"<h2 style='text-align: center;'>{tp_dist:.1f} pips</h2>", unsafe_allow_html=True)
-
-        st.caption(f"Based on Daily ATR (14): {atr_pips:.1f} pips")
+    sl_dist = atr_pips * st.session_state.sl_mult
+    tp_dist = atr_pips * st.session_state.tp_mult
+
+    st.markdown("---")
+    res1, res2 = st.columns(2)
+    with res1:
+        st.markdown(
+            f"<div style='text-align: center;'><h3 style='color: #ff4b4b;'>STOP LOSS</h3>"
+            f"<h2>{sl_dist:.1f} pips</h2></div>",
+            unsafe_allow_html=True
+        )
+    with res2:
+        st.markdown(
+            f"<div style='text-align: center;'><h3 style='color: #09ab3b;'>TAKE PROFIT</h3>"
+            f"<h2>{tp_dist:.1f} pips</h2></div>",
+            unsafe_allow_html=True
+        )
+
+    st.caption(f"Based on Daily ATR (14): {atr_pips:.1f} pips")
+
+if market_data_healthy:
+    risk_calculator(market_data['atr_pips'])
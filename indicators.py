@@ -0,0 +1,25 @@
+import numpy as np
+from numba import njit
+
+# Kept out of app.py: Streamlit re-executes the main script on every rerun,
+# while an imported module (and its compiled kernel) stays loaded
+
+# --- ATR Kernel (JIT, compiled code cached in __pycache__) ---
+@njit(cache=True)
+def calculate_atr(high, low, close, period=14):
+    # Expects closed candles only, the ATR ends on the last row given
+    atr = 0.0
+    for i in range(1, len(close)):
+        # True Range against the previous close
+        tr = max(high[i] - low[i], abs(high[i] - close[i - 1]), abs(low[i] - close[i - 1]))
+
+        if i <= period:
+            # Seed with the simple mean of the first `period` True Ranges
+            atr += tr / period
+        else:
+            # Wilder's smoothing
+            atr = (atr * (period - 1) + tr) / period
+    return atr
+
+# Warm up at import so the first page load doesn't pay for compilation
+calculate_atr(*np.ones((3, 3)))